@@ -0,0 +1,97 @@
+# MicroPython Human Interface Device library
+# Copyright (C) 2021 H. Groefsema
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# Functions to decode advertising payloads, such as those generated by hid_services.Advertiser.
+# These are only needed when scanning for devices, which is why they are kept out of hid_services.
+from micropython import const
+import micropython
+import bluetooth
+
+# Advertising payloads are repeated packets of the following form:
+#   1 byte data length (N + 1)
+#   1 byte type (see constants below)
+#   N bytes type-specific data
+_ADV_TYPE_NAME = const(0x09)
+_ADV_TYPE_UUID16_COMPLETE = const(0x3)
+_ADV_TYPE_UUID32_COMPLETE = const(0x5)
+_ADV_TYPE_UUID128_COMPLETE = const(0x7)
+
+
+# Returns the offset of the first AD structure of the given type at or after start, or -1 if there is none.
+@micropython.viper
+def _find_field(payload, n: int, start: int, adv_type: int) -> int:
+    buf = ptr8(payload)
+    i = start
+    while i + 1 < n:
+        if buf[i + 1] == adv_type:
+            return i
+        i += buf[i] + 1                                                                                                 # Hop to the next AD structure.
+    return -1
+
+
+# Returns the values of all fields of the given type.
+# The values are memoryviews into the payload, so they are only valid as long as the payload is not modified.
+def decode_field(payload, adv_type):
+    mv = memoryview(payload)
+    n = len(payload)
+    result = []
+    i = _find_field(payload, n, 0, adv_type)
+    while i >= 0:
+        ln = payload[i]                                                                                                 # Length of this AD structure, excluding the length byte itself.
+        result.append(mv[i + 2 : i + ln + 1])
+        i = _find_field(payload, n, i + ln + 1, adv_type)
+    return result
+
+
+# Returns a dict mapping each type in the payload to a list of its values, walking the payload once.
+# The values are memoryviews into the payload, so they are only valid as long as the payload is not modified.
+def decode_fields(payload):
+    mv = memoryview(payload)
+    n = len(payload)
+    fields = {}
+    i = 0
+    while i + 1 < n:
+        ln = payload[i]                                                                                                 # Length of this AD structure, excluding the length byte itself.
+        adv_type = payload[i + 1]
+        value = mv[i + 2 : i + ln + 1]
+        values = fields.get(adv_type)
+        if values is None:
+            fields[adv_type] = [value]
+        else:
+            values.append(value)
+        i += ln + 1                                                                                                     # Hop to the next AD structure.
+    return fields
+
+
+# Returns the complete local name.
+def decode_name(payload):
+    n = decode_field(payload, _ADV_TYPE_NAME)
+    return str(n[0], "utf-8") if n else ""
+
+
+# Returns the list of complete service UUIDs.
+def decode_services(payload):
+    fields = decode_fields(payload)
+    services = []
+    for u in fields.get(_ADV_TYPE_UUID16_COMPLETE, ()):
+        services.append(bluetooth.UUID(int.from_bytes(u, "little")))
+    for u in fields.get(_ADV_TYPE_UUID32_COMPLETE, ()):
+        services.append(bluetooth.UUID(int.from_bytes(u, "little")))
+    for u in fields.get(_ADV_TYPE_UUID128_COMPLETE, ()):
+        services.append(bluetooth.UUID(bytes(u)))
+    return services
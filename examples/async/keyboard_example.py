@@ -26,6 +26,7 @@ class Device:
         self.keys = []
         self.updated = False
         self.active = True
+        self.connected = asyncio.ThreadSafeFlag()  # Set by the state callback when a central connects
 
         # Define buttons
         self.pin_w = Pin(5, Pin.IN)
@@ -45,12 +46,13 @@ class Device:
         elif self.keyboard.get_state() is Keyboard.DEVICE_ADVERTISING:
             return
         elif self.keyboard.get_state() is Keyboard.DEVICE_CONNECTED:
+            self.connected.set()
             return
         else:
             return
 
-    def keyboard_event_callback(self, bytes):
-        print("Keyboard state callback with bytes: ", bytes)
+    def keyboard_event_callback(self, report):
+        print("Keyboard state callback with bytes: ", bytes(report))
 
     def advertise(self):
         self.keyboard.start_advertising()
@@ -165,8 +167,10 @@ class Device:
 
     # Test routine
     async def test(self):
+        # Wait until a central connects. The state callback runs from the BLE IRQ, which may
+        # only set a ThreadSafeFlag, so check the state again each time the flag wakes us
         while not self.keyboard.is_connected():
-            await asyncio.sleep(5)
+            await self.connected.wait()
 
         await asyncio.sleep(5)
         self.keyboard.set_battery_level(50)
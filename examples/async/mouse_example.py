@@ -26,6 +26,7 @@ class Device:
         self.axes = (0, 0)
         self.updated = False
         self.active = True
+        self.connected = asyncio.ThreadSafeFlag()  # Set by the state callback when a central connects
 
         # Define buttons
         self.pin_forward = Pin(5, Pin.IN)
@@ -45,6 +46,7 @@ class Device:
         elif self.mouse.get_state() is Mouse.DEVICE_ADVERTISING:
             return
         elif self.mouse.get_state() is Mouse.DEVICE_CONNECTED:
+            self.connected.set()
             return
         else:
             return
@@ -110,8 +112,10 @@ class Device:
 
     # Test routine
     async def test(self):
+        # Wait until a central connects. The state callback runs from the BLE IRQ, which may
+        # only set a ThreadSafeFlag, so check the state again each time the flag wakes us
         while not self.mouse.is_connected():
-            await asyncio.sleep(5)
+            await self.connected.wait()
 
         await asyncio.sleep(5)
         self.mouse.set_battery_level(50)
@@ -52,8 +52,8 @@ class Device:
         else:
             return
 
-    def keyboard_event_callback(self, bytes):
-        print("Keyboard state callback with bytes: ", bytes)
+    def keyboard_event_callback(self, report):
+        print("Keyboard state callback with bytes: ", bytes(report))
 
     def advertise(self):
         self.keyboard.start_advertising()
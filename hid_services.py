@@ -16,9 +16,9 @@
 
 
 from micropython import const
+import micropython
 import struct
 import bluetooth
-import json
 import binascii
 from bluetooth import UUID
 
@@ -31,6 +31,43 @@ F_READ_WRITE_NORESPONSE = bluetooth.FLAG_READ | bluetooth.FLAG_WRITE | bluetooth
 DSC_F_READ = 0x02
 DSC_F_WRITE = 0x03
 
+# Static HID service characteristic values.
+HID_INFO_DEFAULT = b"\x01\x01\x00\x00"                                                                                  # HID info: ver=1.1, country=0, flags=000000cw with c=normally connectable w=wake up signal
+HID_CTRL_ZERO = b"\x00"                                                                                                 # HID control point.
+HID_REF_INPUT_1_1 = b"\x01\x01"                                                                                         # HID reference: id=1, type=input.
+HID_REF_OUTPUT_1_2 = b"\x01\x02"                                                                                        # HID reference: id=1, type=output.
+HID_PROTO_REPORT = b"\x01"                                                                                              # HID protocol mode: report.
+
+# Service, characteristic and descriptor UUIDs. Created once and shared by all service descriptions.
+_UUID_DIS = UUID(0x180A)                                                                                                # 0x180A = Device Information service.
+_UUID_BAS = UUID(0x180F)                                                                                                # 0x180F = Battery service.
+_UUID_DID = UUID(0x1200)                                                                                                # 0x1200 = Device Identification service.
+_UUID_HIDS = UUID(0x1812)                                                                                               # 0x1812 = Human Interface Device service.
+_UUID_MODEL_NUMBER = UUID(0x2A24)                                                                                       # 0x2A24 = Model number string.
+_UUID_SERIAL_NUMBER = UUID(0x2A25)                                                                                      # 0x2A25 = Serial number string.
+_UUID_FIRMWARE_REVISION = UUID(0x2A26)                                                                                  # 0x2A26 = Firmware revision string.
+_UUID_HARDWARE_REVISION = UUID(0x2A27)                                                                                  # 0x2A27 = Hardware revision string.
+_UUID_SOFTWARE_REVISION = UUID(0x2A28)                                                                                  # 0x2A28 = Software revision string.
+_UUID_MANUFACTURER_NAME = UUID(0x2A29)                                                                                  # 0x2A29 = Manufacturer name string.
+_UUID_PNP_ID = UUID(0x2A50)                                                                                             # 0x2A50 = PnP ID.
+_UUID_BATTERY_LEVEL = UUID(0x2A19)                                                                                      # 0x2A19 = Battery level.
+_UUID_PRESENTATION_FORMAT = UUID(0x2904)                                                                                # 0x2904 = Characteristic Presentation Format.
+_UUID_SPECIFICATION_ID = UUID(0x0200)                                                                                   # 0x0200 = SpecificationID.
+_UUID_VENDOR_ID = UUID(0x0201)                                                                                          # 0x0201 = VendorID.
+_UUID_PRODUCT_ID = UUID(0x0202)                                                                                         # 0x0202 = ProductID.
+_UUID_VERSION = UUID(0x0203)                                                                                            # 0x0203 = Version.
+_UUID_PRIMARY_RECORD = UUID(0x0204)                                                                                     # 0x0204 = PrimaryRecord.
+_UUID_VENDOR_ID_SOURCE = UUID(0x0205)                                                                                   # 0x0205 = VendorIDSource.
+_UUID_HID_INFORMATION = UUID(0x2A4A)                                                                                    # 0x2A4A = HID information.
+_UUID_HID_REPORT_MAP = UUID(0x2A4B)                                                                                     # 0x2A4B = HID report map.
+_UUID_HID_CONTROL_POINT = UUID(0x2A4C)                                                                                  # 0x2A4C = HID control point.
+_UUID_HID_REPORT = UUID(0x2A4D)                                                                                         # 0x2A4D = HID report.
+_UUID_HID_REFERENCE = UUID(0x2908)                                                                                      # 0x2908 = HID reference.
+_UUID_HID_PROTOCOL_MODE = UUID(0x2A4E)                                                                                  # 0x2A4E = HID protocol mode.
+
+# Set to 1 to log BLE events and reports. The compiler removes the logging when 0.
+_DEBUG = const(0)
+
 # Advertising payloads are repeated packets of the following form:
 #   1 byte data length (N + 1)
 #   1 byte type (see constants below)
@@ -45,6 +82,12 @@ _ADV_TYPE_UUID32_MORE = const(0x4)
 _ADV_TYPE_UUID128_MORE = const(0x6)
 _ADV_TYPE_APPEARANCE = const(0x19)
 
+# The flags AD structure for general discoverable, LE only devices. Used for every HID advertisement.
+_ADV_FLAGS_GENERAL_LE = b"\x02\x01\x06"
+
+# The complete 16-bit service UUID AD structure for the HID service (0x1812). Used when only the HIDS is advertised.
+_ADV_UUID16_HIDS = b"\x03\x03\x12\x18"
+
 # IRQ peripheral role event codes
 _IRQ_CENTRAL_CONNECT = const(1)
 _IRQ_CENTRAL_DISCONNECT = const(2)
@@ -99,101 +142,165 @@ _GATTS_ERROR_ATTR_NOT_FOUND = const(0x0a)
 _GATTS_ERROR_INSUFFICIENT_ENCRYPTION = const(0x0f)
 _GATTS_ERROR_WRITE_REQ_REJECTED = const(0xFC)
 
-class Advertiser:
-
-    # Generate a payload to be passed to gap_advertise(adv_data=...).
-    def advertising_payload(self, limited_disc=False, br_edr=False, name=None, services=None, appearance=0):
-        payload = bytearray()
-
-        def _append(adv_type, value):
-            nonlocal payload
-            payload += struct.pack("BB", len(value) + 1, adv_type) + value
-
-        _append(
-            _ADV_TYPE_FLAGS,
-            struct.pack("B", (0x01 if limited_disc else 0x02) + (0x18 if br_edr else 0x04)),
-        )
-
-        if name:
-            _append(_ADV_TYPE_NAME, name)
-
-        if services:
+# Device states
+DEVICE_STOPPED = const(0)
+DEVICE_IDLE = const(1)
+DEVICE_ADVERTISING = const(2)
+DEVICE_CONNECTED = const(3)
+
+# Generate a payload to be passed to gap_advertise(adv_data=...).
+# The format of the whole payload is composed first, so it is packed with a single call into a single buffer.
+# Returns the payload and the offsets of the name and appearance values within it, -1 if a field is absent.
+def _build_adv_payload(limited_disc=False, br_edr=False, name=None, services=None, appearance=0):
+    if limited_disc or br_edr:
+        fmt = "<BBB"
+        args = [2, _ADV_TYPE_FLAGS, (0x01 if limited_disc else 0x02) + (0x18 if br_edr else 0x04)]
+    else:
+        fmt = "<3s"
+        args = [_ADV_FLAGS_GENERAL_LE]
+
+    name_off = -1
+    if name:
+        name = name.encode()
+        name_off = struct.calcsize(fmt) + 2                                                                             # The value follows the length and type bytes.
+        fmt += "BB%ds" % len(name)
+        args += (len(name) + 1, _ADV_TYPE_NAME, name)
+
+    if services:
+        if len(services) == 1 and services[0] == _UUID_HIDS:
+            fmt += "4s"
+            args.append(_ADV_UUID16_HIDS)
+        else:
             for uuid in services:
                 b = bytes(uuid)
                 if len(b) == 2:
-                    _append(_ADV_TYPE_UUID16_COMPLETE, b)
+                    adv_type = _ADV_TYPE_UUID16_COMPLETE
                 elif len(b) == 4:
-                    _append(_ADV_TYPE_UUID32_COMPLETE, b)
-                elif len(b) == 16:
-                    _append(_ADV_TYPE_UUID128_COMPLETE, b)
-
-        # See org.bluetooth.characteristic.gap.appearance.xml
-        if appearance:
-            _append(_ADV_TYPE_APPEARANCE, struct.pack("<h", appearance))
-
-        return payload
-
-
-    def decode_field(self, payload, adv_type):
-        i = 0
-        result = []
-        while i + 1 < len(payload):
-            if payload[i + 1] == adv_type:
-                result.append(payload[i + 2 : i + payload[i] + 1])
-            i += 1 + payload[i]
-        return result
+                    adv_type = _ADV_TYPE_UUID32_COMPLETE
+                else:
+                    adv_type = _ADV_TYPE_UUID128_COMPLETE
+                fmt += "BB%ds" % len(b)
+                args += (len(b) + 1, adv_type, b)
 
+    # See org.bluetooth.characteristic.gap.appearance.xml
+    appearance_off = -1
+    if appearance:
+        appearance_off = struct.calcsize(fmt) + 2
+        fmt += "BBh"
+        args += (3, _ADV_TYPE_APPEARANCE, appearance)
 
-    def decode_name(self, payload):
-        n = self.decode_field(payload, _ADV_TYPE_NAME)
-        return str(n[0], "utf-8") if n else ""
+    payload = bytearray(struct.calcsize(fmt))
+    struct.pack_into(fmt, payload, 0, *args)
+    return payload, name_off, appearance_off
 
 
-    def decode_services(self, payload):
-        services = []
-        for u in self.decode_field(payload, _ADV_TYPE_UUID16_COMPLETE):
-            services.append(bluetooth.UUID(struct.unpack("<h", u)[0]))
-        for u in self.decode_field(payload, _ADV_TYPE_UUID32_COMPLETE):
-            services.append(bluetooth.UUID(struct.unpack("<d", u)[0]))
-        for u in self.decode_field(payload, _ADV_TYPE_UUID128_COMPLETE):
-            services.append(bluetooth.UUID(u))
-        return services
+class Advertiser:
 
     # Init as generic HID device (960 = generic HID appearance value).
-    def __init__(self, ble, services=[UUID(0x1812)], appearance=const(960), name="Generic HID Device"):
+    def __init__(self, ble, services=None, appearance=const(960), name="Generic HID Device"):
         self._ble = ble
-        self._payload = self.advertising_payload(name=name, services=services, appearance=appearance)
+        if services is None:
+            services = [_UUID_HIDS]
+        self._services = services
+        self._appearance = appearance
+        self._name = name.encode() if name else b""
+        self._build_payload()
 
         self.advertising = False
-        print("Advertiser created: ", self.decode_name(self._payload), " with services: ", self.decode_services(self._payload))
+        if _DEBUG:
+            print("Advertiser created with payload: ", bytes(self._payload))
 
     # Start advertising at 100000 interval.
     def start_advertising(self):
         if not self.advertising:
             self._ble.gap_advertise(100000, adv_data=self._payload)
-            print("Started advertising")
+            self.advertising = True
+            if _DEBUG:
+                print("Started advertising")
 
     # Stop advertising by setting interval of 0.
     def stop_advertising(self):
         if self.advertising:
             self._ble.gap_advertise(0, adv_data=self._payload)
-            print("Stopped advertising")
+            self.advertising = False
+            if _DEBUG:
+                print("Stopped advertising")
+
+    # Change the advertised name.
+    # A name of the same length is written over the old one in the payload, otherwise the payload is rebuilt.
+    def update_name(self, name):
+        name = name.encode() if name else b""
+        in_place = self._name_off >= 0 and name and len(name) == len(self._name)
+        self._name = name
+        if in_place:
+            self._payload[self._name_off:self._name_off + len(name)] = name
+        else:
+            self._build_payload()
+        self._update_advertising()
+
+    # Change the advertised appearance.
+    # An existing appearance is written over in the payload, otherwise the payload is rebuilt.
+    def update_appearance(self, appearance):
+        self._appearance = appearance
+        if self._appearance_off >= 0 and appearance:
+            struct.pack_into("<h", self._payload, self._appearance_off, appearance)
+        else:
+            self._build_payload()
+        self._update_advertising()
+
+    # (Re)build the payload and remember where its name and appearance values are.
+    def _build_payload(self):
+        self._payload, self._name_off, self._appearance_off = _build_adv_payload(name=self._name.decode(), services=self._services, appearance=self._appearance)
+
+    # Pass the changed payload to the BLE stack if we are advertising.
+    def _update_advertising(self):
+        if self.advertising:
+            self._ble.gap_advertise(100000, adv_data=self._payload)
 
 
 # Class that represents a general HID device services.
 class HumanInterfaceDevice(object):
-    # Define device states
-    DEVICE_STOPPED = const(0)
-    DEVICE_IDLE = const(1)
-    DEVICE_ADVERTISING = const(2)
-    DEVICE_CONNECTED = const(3)
+    # Service descriptions. These are identical for all devices, so they are defined once on the class.
+    DIS = (                                                                                                             # Device Information Service (DIS) description.
+        _UUID_DIS,                                                                                                      # 0x180A = Device Information.
+        (
+            (_UUID_MODEL_NUMBER, F_READ),                                                                               # 0x2A24 = Model number string, to be read by client.
+            (_UUID_SERIAL_NUMBER, F_READ),                                                                              # 0x2A25 = Serial number string, to be read by client.
+            (_UUID_FIRMWARE_REVISION, F_READ),                                                                          # 0x2A26 = Firmware revision string, to be read by client.
+            (_UUID_HARDWARE_REVISION, F_READ),                                                                          # 0x2A27 = Hardware revision string, to be read by client.
+            (_UUID_SOFTWARE_REVISION, F_READ),                                                                          # 0x2A28 = Software revision string, to be read by client.
+            (_UUID_MANUFACTURER_NAME, F_READ),                                                                          # 0x2A29 = Manufacturer name string, to be read by client.
+            (_UUID_PNP_ID, F_READ),                                                                                     # 0x2A50 = PnP ID, to be read by client.
+        ),
+    )
+
+    BAS = (                                                                                                             # Battery Service (BAS) description.
+        _UUID_BAS,                                                                                                      # 0x180F = Battery Information.
+        (
+            (_UUID_BATTERY_LEVEL, F_READ_NOTIFY, (                                                                      # 0x2A19 = Battery level, to be read by client after being notified of change.
+                (_UUID_PRESENTATION_FORMAT, DSC_F_READ),                                                                # 0x2904 = Characteristic Presentation Format.
+            )),
+        ),
+    )
+
+    DID = (                                                                                                             # Device Identification Profile (DID) description.
+        _UUID_DID,                                                                                                      # 0x1200 = PnPInformation.
+        (
+            (_UUID_SPECIFICATION_ID, F_READ),                                                                           # 0x0200 = SpecificationID.
+            (_UUID_VENDOR_ID, F_READ),                                                                                  # 0x0201 = VendorID.
+            (_UUID_PRODUCT_ID, F_READ),                                                                                 # 0x0202 = ProductID.
+            (_UUID_VERSION, F_READ),                                                                                    # 0x0203 = Version.
+            (_UUID_PRIMARY_RECORD, F_READ),                                                                             # 0x0204 = PrimaryRecord.
+            (_UUID_VENDOR_ID_SOURCE, F_READ),                                                                           # 0x0205 = VendorIDSource.
+        ),
+    )
 
     def __init__(self, device_name="Generic HID Device"):
         self._ble = bluetooth.BLE()                                                                                     # The BLE.
         self.adv = None                                                                                                 # The advertiser.
-        self.device_state = HumanInterfaceDevice.DEVICE_STOPPED                                                         # The initial device state.
+        self.device_state = DEVICE_STOPPED                                                                              # The initial device state.
         self.conn_handle = None                                                                                         # The handle of the connected client. HID devices can only have a single connection.
-        self.state_change_callback = None                                                                               # The user defined callback function which gets called when the device state changes.
+        self.state_change_callback = lambda: None                                                                       # The user defined callback function which gets called when the device state changes. Defaults to a no-op.
         self.io_capability = _IO_CAPABILITY_NO_INPUT_OUTPUT                                                             # The IO capability of the device. This is used to allow for different ways of identification during pairing.
         self.bond = True                                                                                                # Do we wish to bond with connecting clients? Normally True. Not supported by older Micropython versions.
         self.le_secure = True                                                                                           # Do we wish to use a secure connection? Normally True. Not supported by older Micropython versions.
@@ -210,7 +317,7 @@ class HumanInterfaceDevice(object):
 
         # General characteristics.
         self.device_name = device_name                                                                                  # The device name.
-        self.service_uuids = [UUID(0x180A), UUID(0x180F), UUID(0x1200), UUID(0x1812)]                                   # Service UUIDs: DIS, BAS, DID, HIDS (Device Information Service, BAttery Service, Device Identification service, Human Interface Device Service). These are required for a HID.
+        self.service_uuids = [_UUID_DIS, _UUID_BAS, _UUID_DID, _UUID_HIDS]                                              # Service UUIDs: DIS, BAS, DID, HIDS (Device Information Service, BAttery Service, Device Identification service, Human Interface Device Service). These are required for a HID.
         self.device_appearance = 960                                                                                    # The device appearance: 960 = Generic HID.
 
         # Device Information Service (DIS) characteristics.
@@ -229,41 +336,7 @@ class HumanInterfaceDevice(object):
 
         # BAttery Service (BAS) characteristics.
         self.battery_level = 100                                                                                        # The battery level characteristic (percentages).
-
-
-        self.DIS = (                                                                                                    # Device Information Service (DIS) description.
-            UUID(0x180A),                                                                                               # 0x180A = Device Information.
-            (
-                (UUID(0x2A24), F_READ),                                                                                 # 0x2A24 = Model number string, to be read by client.
-                (UUID(0x2A25), F_READ),                                                                                 # 0x2A25 = Serial number string, to be read by client.
-                (UUID(0x2A26), F_READ),                                                                                 # 0x2A26 = Firmware revision string, to be read by client.
-                (UUID(0x2A27), F_READ),                                                                                 # 0x2A27 = Hardware revision string, to be read by client.
-                (UUID(0x2A28), F_READ),                                                                                 # 0x2A28 = Software revision string, to be read by client.
-                (UUID(0x2A29), F_READ),                                                                                 # 0x2A29 = Manufacturer name string, to be read by client.
-                (UUID(0x2A50), F_READ),                                                                                 # 0x2A50 = PnP ID, to be read by client.
-            ),
-        )
-
-        self.BAS = (                                                                                                    # Battery Service (BAS) description.
-            UUID(0x180F),                                                                                               # 0x180F = Battery Information.
-            (
-                (UUID(0x2A19), F_READ_NOTIFY, (                                                                         # 0x2A19 = Battery level, to be read by client after being notified of change.
-                    (UUID(0x2904), DSC_F_READ),                                                                         # 0x2904 = Characteristic Presentation Format.
-                )),
-            ),
-        )
-
-        self.DID = (                                                                                                    # Device Identification Profile (DID) description.
-            UUID(0x1200),                                                                                               # 0x1200 = PnPInformation.
-            (
-                (UUID(0x0200), F_READ),                                                                                 # 0x0200 = SpecificationID.
-                (UUID(0x0201), F_READ),                                                                                 # 0x0201 = VendorID.
-                (UUID(0x0202), F_READ),                                                                                 # 0x0202 = ProductID.
-                (UUID(0x0203), F_READ),                                                                                 # 0x0203 = Version.
-                (UUID(0x0204), F_READ),                                                                                 # 0x0204 = PrimaryRecord.
-                (UUID(0x0205), F_READ),                                                                                 # 0x0205 = VendorIDSource.
-            ),
-        )
+        self._bat_buf = bytearray((self.battery_level,))                                                                # Buffer for the battery level as sent to the central.
 
         self.services = [self.DIS, self.BAS, self.DID]                                                                  # List of service descriptions. We will append HIDS in their respective subclasses.
 
@@ -271,123 +344,182 @@ class HumanInterfaceDevice(object):
 
         self.characteristics = {}                                                                                       # List which maps handles to (description, value) tuple.
 
-        print("Server created")
+        self._irq_handlers = {                                                                                          # Maps IRQ event codes to their handler functions. Subclasses overwrite the handler functions.
+            _IRQ_CENTRAL_CONNECT: self._on_central_connect,
+            _IRQ_CENTRAL_DISCONNECT: self._on_central_disconnect,
+            _IRQ_GATTS_WRITE: self._on_gatts_write,
+            _IRQ_GATTS_READ_REQUEST: self._on_gatts_read_request,
+            _IRQ_GATTS_INDICATE_DONE: self._on_gatts_indicate_done,
+            _IRQ_MTU_EXCHANGED: self._on_mtu_exchanged,
+            _IRQ_CONNECTION_UPDATE: self._on_connection_update,
+            _IRQ_ENCRYPTION_UPDATE: self._on_encryption_update,
+            _IRQ_PASSKEY_ACTION: self._on_passkey_action,
+            _IRQ_SET_SECRET: self._on_set_secret,
+            _IRQ_GET_SECRET: self._on_get_secret,
+        }
+
+        if _DEBUG:
+            print("Server created")
 
     # Interrupt request callback function.
+    # Dispatches the event to its handler in self._irq_handlers.
     def ble_irq(self, event, data):
-        if event == _IRQ_CENTRAL_CONNECT:                                                                               # Central connected.
-            self.conn_handle, _, _ = data                                                                               # Save the handle. HIDS specification only allow one central to be connected.
-            self.set_state(HumanInterfaceDevice.DEVICE_CONNECTED)                                                       # Set the device state to connected.
+        handler = self._irq_handlers.get(event)
+        if handler is not None:
+            return handler(data)
+        print("Unhandled IRQ event:", event)
+
+    # Central connected.
+    def _on_central_connect(self, data):
+        self.conn_handle, _, _ = data                                                                                   # Save the handle. HIDS specification only allow one central to be connected.
+        if self.adv is not None:
+            self.adv.advertising = False                                                                                # The BLE stack stops advertising when a central connects.
+        self.set_state(DEVICE_CONNECTED)                                                                                # Set the device state to connected.
+        if _DEBUG:
             print("Central connected:", self.conn_handle)
-        elif event == _IRQ_CENTRAL_DISCONNECT:                                                                          # Central disconnected.
-            conn_handle, addr_type, addr = data
-            self.conn_handle = None                                                                                     # Discard old handle.
-            self.set_state(HumanInterfaceDevice.DEVICE_IDLE)
-            self.encrypted = False
-            self.authenticated = False
-            self.bonded = False
+
+    # Central disconnected.
+    def _on_central_disconnect(self, data):
+        conn_handle, addr_type, addr = data
+        self.conn_handle = None                                                                                         # Discard old handle.
+        self.set_state(DEVICE_IDLE)
+        self.encrypted = False
+        self.authenticated = False
+        self.bonded = False
+        if _DEBUG:
             print("Central disconnected:", conn_handle)
-        elif event == _IRQ_GATTS_WRITE:                                                                                 # Write operation from client.
-            conn_handle, attr_handle = data
-            value = self._ble.gatts_read(attr_handle)
-            description, _val = self.characteristics.get(attr_handle, (None, None))
-            if description is None:
-                print("Client initiated write on unknown handle:", attr_handle, "with value", value)
-                return _GATTS_ERROR_ATTR_NOT_FOUND
-            else:
-                self.characteristics[attr_handle] = (description, value)
+
+    # Write operation from client.
+    def _on_gatts_write(self, data):
+        conn_handle, attr_handle = data
+        value = self._read(attr_handle)
+        description, _val = self.characteristics.get(attr_handle, (None, None))
+        if description is None:
+            print("Client initiated write on unknown handle:", attr_handle, "with value", value)
+            return _GATTS_ERROR_ATTR_NOT_FOUND
+        else:
+            self.characteristics[attr_handle] = (description, value)
+            if _DEBUG:
                 print("Client initiated write on", description, "with value", value)
-                return _GATTS_NO_ERROR
-        elif event == _IRQ_GATTS_READ_REQUEST:                                                                          # Read request from client.
-            conn_handle, attr_handle = data
-            description, val = self.characteristics.get(attr_handle, (None, None))
+            return _GATTS_NO_ERROR
+
+    # Read request from client.
+    def _on_gatts_read_request(self, data):
+        conn_handle, attr_handle = data
+        description, val = self.characteristics.get(attr_handle, (None, None))
+        if _DEBUG:
             print("Read request:", description if description else attr_handle, "with value" if val else "", val if val else "")
-            if conn_handle != self.conn_handle:                                                                         # If different connection, return no permission.
-                return _GATTS_ERROR_READ_NOT_PERMITTED
-            elif description == None:                                                                                   # If the handle is unknown, return invalid handle.
-                return _GATTS_ERROR_INVALID_HANDLE
-            elif self.bond and not self.bonded:                                                                         # If we wish to bond but are not bonded, return insufficient authorization.
-                return _GATTS_ERROR_INSUFFICIENT_AUTHORIZATION
-            elif self.io_capability > _IO_CAPABILITY_NO_INPUT_OUTPUT and not self.authenticated:                        # If we can authenticate but the client hasn't authenticated, return insufficient authentication.
-                return _GATTS_ERROR_INSUFFICIENT_AUTHENTICATION
-            elif self.le_secure and (not self.encrypted or self.key_size < 16):                                         # If we wish for a secure connection but it is unencrypted or not strong enough, return insufficient encryption.
-                return _GATTS_ERROR_INSUFFICIENT_ENCRYPTION
-            else:                                                                                                       # Otherwise, return no error.
-                return _GATTS_NO_ERROR
-        elif event == _IRQ_GATTS_INDICATE_DONE:                                                                         # A sent indication was done. (We don't use indications currently. If needed, define a callback function and override this function.)
-            conn_handle, value_handle, status = data
+        if conn_handle != self.conn_handle:                                                                             # If different connection, return no permission.
+            return _GATTS_ERROR_READ_NOT_PERMITTED
+        elif description == None:                                                                                       # If the handle is unknown, return invalid handle.
+            return _GATTS_ERROR_INVALID_HANDLE
+        elif self.bond and not self.bonded:                                                                             # If we wish to bond but are not bonded, return insufficient authorization.
+            return _GATTS_ERROR_INSUFFICIENT_AUTHORIZATION
+        elif self.io_capability > _IO_CAPABILITY_NO_INPUT_OUTPUT and not self.authenticated:                            # If we can authenticate but the client hasn't authenticated, return insufficient authentication.
+            return _GATTS_ERROR_INSUFFICIENT_AUTHENTICATION
+        elif self.le_secure and (not self.encrypted or self.key_size < 16):                                             # If we wish for a secure connection but it is unencrypted or not strong enough, return insufficient encryption.
+            return _GATTS_ERROR_INSUFFICIENT_ENCRYPTION
+        else:                                                                                                           # Otherwise, return no error.
+            return _GATTS_NO_ERROR
+
+    # A sent indication was done. (We don't use indications currently. If needed, define a callback function and override this function.)
+    def _on_gatts_indicate_done(self, data):
+        conn_handle, value_handle, status = data
+        if _DEBUG:
             print("Indicate done:", data)
-        elif event == _IRQ_MTU_EXCHANGED:                                                                               # MTU was exchanged, set it.
-            conn_handle, mtu = data
-            self._ble.config(mtu=mtu)
+
+    # MTU was exchanged, set it.
+    def _on_mtu_exchanged(self, data):
+        conn_handle, mtu = data
+        self._ble.config(mtu=mtu)
+        if _DEBUG:
             print("MTU exchanged:", mtu)
-        elif event == _IRQ_CONNECTION_UPDATE:                                                                           # Connection parameters were updated.
-            self.conn_handle, conn_interval, conn_latency, supervision_timeout, status = data                           # The new parameters.
+
+    # Connection parameters were updated.
+    def _on_connection_update(self, data):
+        self.conn_handle, conn_interval, conn_latency, supervision_timeout, status = data                               # The new parameters.
+        if _DEBUG:
             print("Connection update. Interval=", conn_interval, "latency=", conn_latency, "timeout=", supervision_timeout, "status=", status)
-            return None                                                                                                 # Return an empty packet.
-        elif event == _IRQ_ENCRYPTION_UPDATE:                                                                           # Encryption was updated.
-            conn_handle, self.encrypted, self.authenticated, self.bonded, self.key_size = data                          # Update the values.
+        return None                                                                                                     # Return an empty packet.
+
+    # Encryption was updated.
+    def _on_encryption_update(self, data):
+        conn_handle, self.encrypted, self.authenticated, self.bonded, self.key_size = data                              # Update the values.
+        if _DEBUG:
             print("Encryption update:", conn_handle, self.encrypted, self.authenticated, self.bonded, self.key_size)
-        elif event == _IRQ_PASSKEY_ACTION:                                                                              # Passkey actions: accept connection or show/enter passkey.
-            conn_handle, action, passkey = data
+
+    # Passkey actions: accept connection or show/enter passkey.
+    def _on_passkey_action(self, data):
+        conn_handle, action, passkey = data
+        if _DEBUG:
             print("Passkey action:", conn_handle, action, passkey)
-            if action == _PASSKEY_ACTION_NUMCMP:                                                                        # Do we accept this connection?
-                accept = False
-                if self.passkey_callback is not None:                                                                   # Is callback function set?
-                    accept = self.passkey_callback()                                                                    # Call callback for input.
-                self._ble.gap_passkey(conn_handle, action, accept)
-            elif action == _PASSKEY_ACTION_DISP:                                                                        # Show our passkey.
+        if action == _PASSKEY_ACTION_NUMCMP:                                                                            # Do we accept this connection?
+            accept = False
+            if self.passkey_callback is not None:                                                                       # Is callback function set?
+                accept = self.passkey_callback()                                                                        # Call callback for input.
+            self._ble.gap_passkey(conn_handle, action, accept)
+        elif action == _PASSKEY_ACTION_DISP:                                                                            # Show our passkey.
+            if _DEBUG:
                 print("Displaying passkey")
-                self._ble.gap_passkey(conn_handle, action, self.passkey)
-            elif action == _PASSKEY_ACTION_INPUT:                                                                       # Enter passkey.
+            self._ble.gap_passkey(conn_handle, action, self.passkey)
+        elif action == _PASSKEY_ACTION_INPUT:                                                                           # Enter passkey.
+            if _DEBUG:
                 print("Prompting for passkey")
-                pk = None
-                if self.passkey_callback is not None:                                                                   # Is callback function set?
-                    pk = self.passkey_callback()                                                                        # Call callback for input.
-                self._ble.gap_passkey(conn_handle, action, pk)
-            else:
-                print("Unknown passkey action")
-        elif event == _IRQ_SET_SECRET:                                                                                  # Set secret for bonding.
-            sec_type, key, value = data
-            key = (sec_type, bytes(key))
-            value = bytes(value) if value else None
-            if value is None:                                                                                           # If value is empty, and
-                if key in self.secrets:                                                                                 # If key is known then
-                    del self.secrets[key]                                                                               # Forget key
-                    self.save_secrets()
+            pk = None
+            if self.passkey_callback is not None:                                                                       # Is callback function set?
+                pk = self.passkey_callback()                                                                            # Call callback for input.
+            self._ble.gap_passkey(conn_handle, action, pk)
+        else:
+            print("Unknown passkey action")
+
+    # Set secret for bonding.
+    def _on_set_secret(self, data):
+        sec_type, key, value = data
+        key = (sec_type, bytes(key))
+        value = bytes(value) if value else None
+        if value is None:                                                                                               # If value is empty, and
+            if key in self.secrets:                                                                                     # If key is known then
+                del self.secrets[key]                                                                                   # Forget key
+                self.save_secrets()
+                if _DEBUG:
                     print("Removing secret:", key)
-                    return True
-                else:
-                    print("Secret not found:", key)
-                    return False
+                return True
             else:
-                self.secrets[key] = value                                                                               # Remember key/value
-                self.save_secrets()
+                print("Secret not found:", key)
+                return False
+        else:
+            self.secrets[key] = value                                                                                   # Remember key/value
+            self.save_secrets()
+            if _DEBUG:
                 print("Saving secret:", key, value)
-            return True
-        elif event == _IRQ_GET_SECRET:                                                                                  # Get secret for bonding
-            sec_type, index, key = data
-            _key = (sec_type, bytes(key) if key else None)
-            value = None
-            if key is None:
-                i = 0
-                for (t, _k), _val in self.secrets.items():
-                    if t == sec_type:
-                        if i == index:
-                            value = _val
-                        i += 1
-            else:
-                value = self.secrets.get(_key, None)
-            print("Returning secret:", bytes(value) if value else None, "for", "key" if key else "index", _key if key else index, "with type", sec_type)
-            return value
+        return True
+
+    # Get secret for bonding
+    def _on_get_secret(self, data):
+        sec_type, index, key = data
+        _key = (sec_type, bytes(key) if key else None)
+        value = None
+        if key is None:
+            i = 0
+            for (t, _k), _val in self.secrets.items():
+                if t == sec_type:
+                    if i == index:
+                        value = _val
+                    i += 1
         else:
-            print("Unhandled IRQ event:", event)
+            value = self.secrets.get(_key, None)
+        if _DEBUG:
+            print("Returning secret:", bytes(value) if value else None, "for", "key" if key else "index", _key if key else index, "with type", sec_type)
+        return value
 
     # Start the service.
     # Must be overwritten by subclass, and called in
     # the overwritten function by using super(Subclass, self).start().
     def start(self):
-        if self.device_state is HumanInterfaceDevice.DEVICE_STOPPED:
+        if self.device_state is DEVICE_STOPPED:
+            self._notify = self._ble.gatts_notify                                                                       # Cache the bound methods used on every report and write.
+            self._read = self._ble.gatts_read
+            self._write = self._ble.gatts_write
             self._ble.irq(self.ble_irq)                                                                                 # Set interrupt request callback function.
             self._ble.active(1)                                                                                         # Turn on BLE radio.
 
@@ -399,18 +531,20 @@ class HumanInterfaceDevice(object):
             self._ble.config(mitm=self.le_secure)                                                                       # Require man in the middle protection.
             self._ble.config(io=self.io_capability)                                                                     # Set our input/output capabilities. Determines whether and how passkeys are used.
 
-            self.set_state(HumanInterfaceDevice.DEVICE_IDLE)                                                            # Update the device state.
+            self.set_state(DEVICE_IDLE)                                                                                 # Update the device state.
 
             (addr_type, addr) = self._ble.config('mac')                                                                 # Get our address type and mac address.
 
-            print("BLE on with", "random" if addr_type else "public", "mac address", addr)
+            if _DEBUG:
+                print("BLE on with", "random" if addr_type else "public", "mac address", addr)
 
     # After registering the DIS and BAS services, write their characteristic values.
     # Must be overwritten by subclass, and called in
     # the overwritten function by using
     # super(Subclass, self).save_service_characteristics(handles).
     def save_service_characteristics(self, handles):
-        print("Writing service characteristics")
+        if _DEBUG:
+            print("Writing service characteristics")
 
         (h_mod, h_ser, h_fwr, h_hwr, h_swr, h_man, h_pnp) = handles[0]                                                  # Get handles to DIS service characteristics. These correspond directly to its definition in self.DIS. Position 0 because of the order of self.services.
         (self.h_bat, h_bfmt,) = handles[1]                                                                              # Get handles to BAS service characteristics. These correspond directly to its definition in self.BAS. Position 1 because of the order of self.services.
@@ -420,20 +554,24 @@ class HumanInterfaceDevice(object):
         def string_pack(in_str, nr_bytes):
             return struct.pack(str(nr_bytes)+"s", in_str.encode('UTF-8'))
 
-        print("Saving device information service characteristics")
+        if _DEBUG:
+            print("Saving device information service characteristics")
         self.characteristics[h_mod] = ("Model number", string_pack(self.model_number, 24))
         self.characteristics[h_ser] = ("Serial number", string_pack(self.serial_number, 16))
         self.characteristics[h_fwr] = ("Firmware revision", string_pack(self.firmware_revision, 8))
         self.characteristics[h_hwr] = ("Hardware revision", string_pack(self.hardware_revision, 16))
         self.characteristics[h_swr] = ("Software revision", string_pack(self.software_revision, 8))
         self.characteristics[h_man] = ("Manufacturer name", string_pack(self.manufacture_name, 36))
-        self.characteristics[h_pnp] = ("PnP information", struct.pack(">BHHH", self.pnp_manufacturer_source, self.pnp_manufacturer_uuid, self.pnp_product_id, self.pnp_product_version))
+        self.characteristics[h_pnp] = ("PnP information", struct.pack("<BHHH", self.pnp_manufacturer_source, self.pnp_manufacturer_uuid, self.pnp_product_id, self.pnp_product_version))
 
-        print("Saving battery service characteristics")
-        self.characteristics[self.h_bat] = ("Battery level", struct.pack("<B", self.battery_level))
+        if _DEBUG:
+            print("Saving battery service characteristics")
+        self._bat_buf[0] = self.battery_level
+        self.characteristics[self.h_bat] = ("Battery level", self._bat_buf)
         self.characteristics[h_bfmt] = ("Battery format", b'\x04\x00\xad\x27\x01\x00\x00')
 
-        print("Saving device identification service characteristics")
+        if _DEBUG:
+            print("Saving device identification service characteristics")
         self.characteristics[h_sid] = ("Specification ID", b'0x0103')
         self.characteristics[h_vid] = ("Vendor ID", struct.pack(">H", self.pnp_manufacturer_uuid))
         self.characteristics[h_pid] = ("Product ID", struct.pack(">H", self.pnp_product_id))
@@ -443,8 +581,8 @@ class HumanInterfaceDevice(object):
 
     # Stop the service.
     def stop(self):
-        if self.device_state is not HumanInterfaceDevice.DEVICE_STOPPED:
-            if self.device_state is HumanInterfaceDevice.DEVICE_ADVERTISING:
+        if self.device_state is not DEVICE_STOPPED:
+            if self.device_state is DEVICE_ADVERTISING:
                 self.adv.stop_advertising()
 
             if self.conn_handle is not None:
@@ -453,23 +591,45 @@ class HumanInterfaceDevice(object):
 
             self._ble.active(0)
 
-            self.set_state(HumanInterfaceDevice.DEVICE_STOPPED)
-            print("Server stopped")
+            self.set_state(DEVICE_STOPPED)
+            if _DEBUG:
+                print("Server stopped")
 
     # Write service characteristics
     def write_service_characteristics(self):
-        print("Writing service characteristics")
+        if _DEBUG:
+            print("Writing service characteristics")
 
+        write = self._write
         for handle, (name, value) in self.characteristics.items():
-            self._ble.gatts_write(handle, value)
+            if value is not None:
+                write(handle, value)
 
     # Load bonding keys from json file.
+    # Secrets are stored as a single base64 encoded blob of records, each record being
+    # a "<BHH" header (type, key length, value length) followed by the raw key and value.
+    # The older format, a list of (type, key, value) entries, is still accepted.
+    # The file is parsed by hand to keep the json module off the boot path.
     def load_secrets(self):
         try:
             with open("keys.json", "r") as file:
-                entries = json.load(file)
-                for sec_type, key, value in entries:
-                    self.secrets[sec_type, binascii.a2b_base64(key)] = binascii.a2b_base64(value)
+                text = file.read().strip()
+            if text[0] == "{":                                                                                          # {"v": 1, "data": "<base64>"}
+                blob = binascii.a2b_base64(text.split('"data"', 1)[1].split('"')[1])
+                i = 0
+                while i < len(blob):
+                    sec_type, key_len, value_len = struct.unpack_from("<BHH", blob, i)
+                    i += 5
+                    key = blob[i:i + key_len]
+                    i += key_len
+                    self.secrets[sec_type, key] = blob[i:i + value_len]
+                    i += value_len
+            else:                                                                                                       # [[type, "key", "value"], ...]
+                for entry in text[1:-1].split("]"):
+                    fields = entry.strip(" ,[").split(",")
+                    if len(fields) == 3:
+                        sec_type, key, value = fields
+                        self.secrets[int(sec_type), binascii.a2b_base64(key.strip(' "'))] = binascii.a2b_base64(value.strip(' "'))
         except:
             print("No secrets available")
 
@@ -477,31 +637,35 @@ class HumanInterfaceDevice(object):
     def save_secrets(self):
         try:
             with open("keys.json", "w") as file:
-                json_secrets = [
-                    (sec_type, binascii.b2a_base64(key, newline=False), binascii.b2a_base64(value, newline=False))
-                    for (sec_type, key), value in self.secrets.items()
-                ]
-                json.dump(json_secrets, file)
+                blob = bytearray(sum(5 + len(key) + len(value) for (sec_type, key), value in self.secrets.items()))
+                i = 0
+                for (sec_type, key), value in self.secrets.items():
+                    struct.pack_into("<BHH", blob, i, sec_type, len(key), len(value))
+                    i += 5
+                    blob[i:i + len(key)] = key
+                    i += len(key)
+                    blob[i:i + len(value)] = value
+                    i += len(value)
+                file.write('{"v": 1, "data": "' + binascii.b2a_base64(blob, newline=False).decode() + '"}')
         except:
             print("Failed to save secrets")
 
     # Returns whether the device is not stopped.
     def is_running(self):
-        return self.device_state is not HumanInterfaceDevice.DEVICE_STOPPED
+        return self.device_state is not DEVICE_STOPPED
 
     # Returns whether the device is connected with a client.
     def is_connected(self):
-        return self.device_state is HumanInterfaceDevice.DEVICE_CONNECTED
+        return self.device_state is DEVICE_CONNECTED
 
     # Returns whether the device services are being advertised.
     def is_advertising(self):
-        return self.device_state is HumanInterfaceDevice.DEVICE_ADVERTISING
+        return self.device_state is DEVICE_ADVERTISING
 
     # Set a new state and notify the user's callback function.
     def set_state(self, state):
         self.device_state = state
-        if self.state_change_callback is not None:
-            self.state_change_callback()
+        self.state_change_callback()
 
     # Returns the state of the device, i.e.
     # - DEVICE_STOPPED,
@@ -516,21 +680,22 @@ class HumanInterfaceDevice(object):
     # - DEVICE_IDLE,
     # - DEVICE_ADVERTISING, or
     # - DEVICE_CONNECTED.
+    # Passing None removes the callback.
     def set_state_change_callback(self, callback):
-        self.state_change_callback = callback
+        self.state_change_callback = callback if callback is not None else lambda: None
 
     # Begin advertising the device services.
     def start_advertising(self):
-        if self.device_state is not HumanInterfaceDevice.DEVICE_STOPPED and self.device_state is not HumanInterfaceDevice.DEVICE_ADVERTISING:
+        if self.device_state is not DEVICE_STOPPED and self.device_state is not DEVICE_ADVERTISING:
             self.adv.start_advertising()
-            self.set_state(HumanInterfaceDevice.DEVICE_ADVERTISING)
+            self.set_state(DEVICE_ADVERTISING)
 
     # Stop advertising the device services.
     def stop_advertising(self):
-        if self.device_state is not HumanInterfaceDevice.DEVICE_STOPPED:
+        if self.device_state is not DEVICE_STOPPED:
             self.adv.stop_advertising()
-            if self.device_state is not HumanInterfaceDevice.DEVICE_CONNECTED:
-                self.set_state(HumanInterfaceDevice.DEVICE_IDLE)
+            if self.device_state is not DEVICE_CONNECTED:
+                self.set_state(DEVICE_IDLE)
 
     # Returns the device name.
     def get_device_name(self):
@@ -556,6 +721,7 @@ class HumanInterfaceDevice(object):
             self.battery_level = 0
         else:
             self.battery_level = level
+        self._bat_buf[0] = self.battery_level
 
     # Set device information.
     # Must be called before calling Start().
@@ -619,75 +785,81 @@ class HumanInterfaceDevice(object):
 
     # Notifies the client by writing to the battery level handle.
     def notify_battery_level(self):
-        if self.is_connected():
-            print("Notify battery level: ", self.battery_level)
-            value = struct.pack("<B", self.battery_level)
-            self.characteristics[self.h_bat] = ("Battery level", value)
-            self._ble.gatts_notify(self.conn_handle, self.h_bat, value)
+        if self.device_state is DEVICE_CONNECTED:
+            if _DEBUG:
+                print("Notify battery level: ", self.battery_level)
+            self._bat_buf[0] = self.battery_level
+            self._notify(self.conn_handle, self.h_bat, self._bat_buf)
 
     # Notifies the client of the HID state.
     # Must be overwritten by subclass.
     def notify_hid_report(self):
         return
 
+# Expose the device states on the class as well, e.g., HumanInterfaceDevice.DEVICE_IDLE.
+# The module level names are consts and can't be assigned to in the class body.
+HumanInterfaceDevice.DEVICE_STOPPED = DEVICE_STOPPED
+HumanInterfaceDevice.DEVICE_IDLE = DEVICE_IDLE
+HumanInterfaceDevice.DEVICE_ADVERTISING = DEVICE_ADVERTISING
+HumanInterfaceDevice.DEVICE_CONNECTED = DEVICE_CONNECTED
+
+# Base class IRQ handlers that subclasses fall back on. Calling these directly avoids the super() lookup in the IRQ path.
+_base_on_gatts_write = HumanInterfaceDevice._on_gatts_write
+
+# fmt: off
+_REPORT_MAP_JOYSTICK = (                                                                                                # Joystick report description.
+    b"\x05\x01"                                                                                                         # USAGE_PAGE (Generic Desktop)
+    b"\x09\x04"                                                                                                         # USAGE (Joystick)
+    b"\xa1\x01"                                                                                                         # COLLECTION (Application)
+    b"\x85\x01"                                                                                                         #   REPORT_ID (1)
+    b"\xa1\x00"                                                                                                         #   COLLECTION (Physical)
+    b"\x09\x30"                                                                                                         #     USAGE (X)
+    b"\x09\x31"                                                                                                         #     USAGE (Y)
+    b"\x15\x81"                                                                                                         #     LOGICAL_MINIMUM (-127)
+    b"\x25\x7f"                                                                                                         #     LOGICAL_MAXIMUM (127)
+    b"\x75\x08"                                                                                                         #     REPORT_SIZE (8)
+    b"\x95\x02"                                                                                                         #     REPORT_COUNT (2)
+    b"\x81\x02"                                                                                                         #     INPUT (Data,Var,Abs)
+    b"\x05\x09"                                                                                                         #     USAGE_PAGE (Button)
+    b"\x29\x08"                                                                                                         #     USAGE_MAXIMUM (Button 8)
+    b"\x19\x01"                                                                                                         #     USAGE_MINIMUM (Button 1)
+    b"\x95\x08"                                                                                                         #     REPORT_COUNT (8)
+    b"\x75\x01"                                                                                                         #     REPORT_SIZE (1)
+    b"\x25\x01"                                                                                                         #     LOGICAL_MAXIMUM (1)
+    b"\x15\x00"                                                                                                         #     LOGICAL_MINIMUM (0)
+    b"\x81\x02"                                                                                                         #     Input (Data, Variable, Absolute)
+    b"\xc0"                                                                                                             #   END_COLLECTION
+    b"\xc0"                                                                                                             # END_COLLECTION
+)
+# fmt: on
+
 # Class that represents the Joystick service.
 class Joystick(HumanInterfaceDevice):
+    HIDS = (                                                                                                            # HID service description: describes the service and how we communicate.
+        _UUID_HIDS,                                                                                                     # 0x1812 = Human Interface Device.
+        (
+            (_UUID_HID_INFORMATION, F_READ),                                                                            # 0x2A4A = HID information characteristic, to be read by client.
+            (_UUID_HID_REPORT_MAP, F_READ),                                                                             # 0x2A4B = HID USB report map, to be read by client.
+            (_UUID_HID_CONTROL_POINT, F_READ_WRITE_NORESPONSE),                                                         # 0x2A4C = HID control point, to be written by client.
+            (_UUID_HID_REPORT, F_READ_NOTIFY, (                                                                         # 0x2A4D = HID report, to be read by client after notification.
+                (_UUID_HID_REFERENCE, DSC_F_READ),                                                                      # 0x2908 = HID reference, to be read by client.
+            )),
+            (_UUID_HID_PROTOCOL_MODE, F_READ_WRITE_NORESPONSE),                                                         # 0x2A4E = HID protocol mode, to be written & read by client.
+        ),
+    )
+
     def __init__(self, name="Bluetooth Joystick"):
         super(Joystick, self).__init__(name)                                                                            # Set up the general HID services in super.
         self.device_appearance = 963                                                                                    # Overwrite the device appearance ID, 963 = joystick.
 
-        self.HIDS = (                                                                                                   # HID service description: describes the service and how we communicate.
-            UUID(0x1812),                                                                                               # 0x1812 = Human Interface Device.
-            (
-                (UUID(0x2A4A), F_READ),                                                                                 # 0x2A4A = HID information characteristic, to be read by client.
-                (UUID(0x2A4B), F_READ),                                                                                 # 0x2A4B = HID USB report map, to be read by client.
-                (UUID(0x2A4C), F_READ_WRITE_NORESPONSE),                                                                # 0x2A4C = HID control point, to be written by client.
-                (UUID(0x2A4D), F_READ_NOTIFY, (                                                                         # 0x2A4D = HID report, to be read by client after notification.
-                    (UUID(0x2908), DSC_F_READ),                                                                         # 0x2908 = HID reference, to be read by client.
-                )),
-                (UUID(0x2A4E), F_READ_WRITE_NORESPONSE),                                                                # 0x2A4E = HID protocol mode, to be written & read by client.
-            ),
-        )
-
-        # fmt: off
-        self.HID_INPUT_REPORT = [                                                                                       # USB Report Description: describes what we communicate.
-            0x05, 0x01,                                                                                                 # USAGE_PAGE (Generic Desktop)
-            0x09, 0x04,                                                                                                 # USAGE (Joystick)
-            0xa1, 0x01,                                                                                                 # COLLECTION (Application)
-            0x85, 0x01,                                                                                                 #   REPORT_ID (1)
-            0xa1, 0x00,                                                                                                 #   COLLECTION (Physical)
-            0x09, 0x30,                                                                                                 #     USAGE (X)
-            0x09, 0x31,                                                                                                 #     USAGE (Y)
-            0x15, 0x81,                                                                                                 #     LOGICAL_MINIMUM (-127)
-            0x25, 0x7f,                                                                                                 #     LOGICAL_MAXIMUM (127)
-            0x75, 0x08,                                                                                                 #     REPORT_SIZE (8)
-            0x95, 0x02,                                                                                                 #     REPORT_COUNT (2)
-            0x81, 0x02,                                                                                                 #     INPUT (Data,Var,Abs)
-            0x05, 0x09,                                                                                                 #     USAGE_PAGE (Button)
-            0x29, 0x08,                                                                                                 #     USAGE_MAXIMUM (Button 8)
-            0x19, 0x01,                                                                                                 #     USAGE_MINIMUM (Button 1)
-            0x95, 0x08,                                                                                                 #     REPORT_COUNT (8)
-            0x75, 0x01,                                                                                                 #     REPORT_SIZE (1)
-            0x25, 0x01,                                                                                                 #     LOGICAL_MAXIMUM (1)
-            0x15, 0x00,                                                                                                 #     LOGICAL_MINIMUM (0)
-            0x81, 0x02,                                                                                                 #     Input (Data, Variable, Absolute)
-            0xc0,                                                                                                       #   END_COLLECTION
-            0xc0                                                                                                        # END_COLLECTION
-        ]
-        # fmt: on
+        self.HID_INPUT_REPORT = _REPORT_MAP_JOYSTICK                                                                    # Report Description: describes what we communicate. Overwrite to use a different report map.
 
         # Define the initial joystick state.
         self.x = 0
         self.y = 0
 
-        self.button1 = 0
-        self.button2 = 0
-        self.button3 = 0
-        self.button4 = 0
-        self.button5 = 0
-        self.button6 = 0
-        self.button7 = 0
-        self.button8 = 0
+        self._buttons_byte = 0                                                                                          # Bitpacked button states, kept up to date by set_buttons.
+        self._report_buf = bytearray(3)                                                                                 # Preallocated report buffer, reused for every notification.
 
         self.services.append(self.HIDS)                                                                                 # Append to list of service descriptions.
 
@@ -695,12 +867,14 @@ class Joystick(HumanInterfaceDevice):
     def start(self):
         super(Joystick, self).start()                                                                                   # Start super to register DIS and BAS services.
 
-        print("Registering services")
+        if _DEBUG:
+            print("Registering services")
         handles = self._ble.gatts_register_services(self.services)                                                      # Register services and get read/write handles for all services.
         self.save_service_characteristics(handles)                                                                      # Save the values for the characteristics.
+        self.adv = Advertiser(self._ble, [_UUID_HIDS], self.device_appearance, self.device_name)                        # Create an Advertiser. Only advertise the top level service, i.e., the HIDS.
         self.write_service_characteristics()                                                                            # Write the values for the characteristics.
-        self.adv = Advertiser(self._ble, [UUID(0x1812)], self.device_appearance, self.device_name)                      # Create an Advertiser. Only advertise the top level service, i.e., the HIDS.
-        print("Server started")
+        if _DEBUG:
+            print("Server started")
 
     # Overwrite super to save HID specific characteristics.
     def save_service_characteristics(self, handles):
@@ -708,113 +882,118 @@ class Joystick(HumanInterfaceDevice):
 
         (h_info, h_hid, h_ctrl, self.h_rep, h_d1, h_proto) = handles[3]                                                 # Get the handles for the HIDS characteristics. These correspond directly to self.HIDS. Position 3 because of the order of self.services.
 
-        b = self.button1 + self.button2 * 2 + self.button3 * 4 + self.button4 * 8 + self.button5 * 16 + self.button6 * 32 + self.button7 * 64 + self.button8 * 128
-        state = struct.pack("bbB", self.x, self.y, b)                                                                   # Pack the initial joystick state as described by the input report.
+        buf = self._report_buf                                                                                          # Write the initial joystick state as described by the input report.
+        buf[0] = self.x & 0xFF
+        buf[1] = self.y & 0xFF
+        buf[2] = self._buttons_byte
 
-        print("Saving HID service characteristics")
+        if _DEBUG:
+            print("Saving HID service characteristics")
         # Save service characteristics
-        self.characteristics[h_info] = ("HID information", b"\x01\x01\x00\x00")                                         # HID info: ver=1.1, country=0, flags=000000cw with c=normally connectable w=wake up signal
-        self.characteristics[h_hid] = ("HID input report map", bytes(self.HID_INPUT_REPORT))                            # HID input report map.
-        self.characteristics[h_ctrl] = ("HID control point", b"\x00")                                                   # HID control point.
-        self.characteristics[self.h_rep] = ("HID report", state)                                                        # HID report.
-        self.characteristics[h_d1] = ("HID reference", struct.pack("<BB", 1, 1))                                        # HID reference: id=1, type=input.
-        self.characteristics[h_proto] = ("HID protocol mode", b"\x01")                                                  # HID protocol mode: report.
+        self.characteristics.update({
+            h_info: ("HID information", HID_INFO_DEFAULT),                                                              # HID info: ver=1.1, country=0, flags=000000cw with c=normally connectable w=wake up signal
+            h_hid: ("HID input report map", self.HID_INPUT_REPORT),                                                     # HID input report map.
+            h_ctrl: ("HID control point", HID_CTRL_ZERO),                                                               # HID control point.
+            self.h_rep: ("HID report", self._report_buf),                                                               # HID report.
+            h_d1: ("HID reference", HID_REF_INPUT_1_1),                                                                 # HID reference: id=1, type=input.
+            h_proto: ("HID protocol mode", HID_PROTO_REPORT),                                                           # HID protocol mode: report.
+        })
 
     # Overwrite super to notify central of a hid report.
+    @micropython.native
     def notify_hid_report(self):
-        if self.is_connected():
-            b = self.button1 + self.button2 * 2 + self.button3 * 4 + self.button4 * 8 + self.button5 * 16 + self.button6 * 32 + self.button7 * 64 + self.button8 * 128
-            state = struct.pack("bbB", self.x, self.y, b)                                                               # Pack the joystick state as described by the input report.
-            self.characteristics[self.h_rep] = ("HID report", state)
-            self._ble.gatts_notify(self.conn_handle, self.h_rep, state)                                                 # Notify client by writing to the report handle.
-            print("Notify with report: ", struct.unpack("bbB", state))
+        if self.device_state is DEVICE_CONNECTED:
+            buf = self._report_buf                                                                                      # Write the joystick state as described by the input report.
+            buf[0] = self.x & 0xFF
+            buf[1] = self.y & 0xFF
+            buf[2] = self._buttons_byte
+            self._notify(self.conn_handle, self.h_rep, buf)                                                             # Notify client by writing to the report handle.
+            if _DEBUG:
+                print("Notify with report: ", buf)
 
     # Set the joystick axes values.
+    @micropython.native
     def set_axes(self, x=0, y=0):
-        if x > 127:
-            x = 127
-        elif x < -127:
-            x = -127
-
-        if y > 127:
-            y = 127
-        elif y < -127:
-            y = -127
-
-        self.x = x
-        self.y = y
+        self.x = -127 if x < -127 else 127 if x > 127 else x                                                            # Clamp to the logical range of the input report.
+        self.y = -127 if y < -127 else 127 if y > 127 else y
 
     # Set the joystick button values.
+    @micropython.native
     def set_buttons(self, b1=0, b2=0, b3=0, b4=0, b5=0, b6=0, b7=0, b8=0):
-        self.button1 = b1
-        self.button2 = b2
-        self.button3 = b3
-        self.button4 = b4
-        self.button5 = b5
-        self.button6 = b6
-        self.button7 = b7
-        self.button8 = b8
+        self._buttons_byte = b1 | (b2 << 1) | (b3 << 2) | (b4 << 3) | (b5 << 4) | (b6 << 5) | (b7 << 6) | (b8 << 7)
+
+    # Set the joystick axes and buttons (bit 0 = button 1) at once and notify the central, but only if the report changed.
+    @micropython.native
+    def update_state(self, x=0, y=0, buttons=0):
+        self.x = x = -127 if x < -127 else 127 if x > 127 else x
+        self.y = y = -127 if y < -127 else 127 if y > 127 else y
+        self._buttons_byte = b = buttons & 0xFF
+
+        buf = self._report_buf                                                                                          # Holds the last report sent to the central.
+        if buf[0] != x & 0xFF or buf[1] != y & 0xFF or buf[2] != b:
+            self.notify_hid_report()
+
+# fmt: off
+_REPORT_MAP_MOUSE = (                                                                                                   # Mouse report description.
+    b"\x05\x01"                                                                                                         # USAGE_PAGE (Generic Desktop)
+    b"\x09\x02"                                                                                                         # USAGE (Mouse)
+    b"\xa1\x01"                                                                                                         # COLLECTION (Application)
+    b"\x85\x01"                                                                                                         #   REPORT_ID (1)
+    b"\x09\x01"                                                                                                         #   USAGE (Pointer)
+    b"\xa1\x00"                                                                                                         #   COLLECTION (Physical)
+    b"\x05\x09"                                                                                                         #         Usage Page (Buttons)
+    b"\x19\x01"                                                                                                         #         Usage Minimum (1)
+    b"\x29\x03"                                                                                                         #         Usage Maximum (3)
+    b"\x15\x00"                                                                                                         #         Logical Minimum (0)
+    b"\x25\x01"                                                                                                         #         Logical Maximum (1)
+    b"\x95\x03"                                                                                                         #         Report Count (3)
+    b"\x75\x01"                                                                                                         #         Report Size (1)
+    b"\x81\x02"                                                                                                         #         Input(Data, Variable, Absolute); 3 button bits
+    b"\x95\x01"                                                                                                         #         Report Count(1)
+    b"\x75\x05"                                                                                                         #         Report Size(5)
+    b"\x81\x03"                                                                                                         #         Input(Constant);                 5 bit padding
+    b"\x05\x01"                                                                                                         #         Usage Page (Generic Desktop)
+    b"\x09\x30"                                                                                                         #         Usage (X)
+    b"\x09\x31"                                                                                                         #         Usage (Y)
+    b"\x09\x38"                                                                                                         #         Usage (Wheel)
+    b"\x15\x81"                                                                                                         #         Logical Minimum (-127)
+    b"\x25\x7F"                                                                                                         #         Logical Maximum (127)
+    b"\x75\x08"                                                                                                         #         Report Size (8)
+    b"\x95\x03"                                                                                                         #         Report Count (3)
+    b"\x81\x06"                                                                                                         #         Input(Data, Variable, Relative); 3 position bytes (X,Y,Wheel)
+    b"\xc0"                                                                                                             #   END_COLLECTION
+    b"\xc0"                                                                                                             # END_COLLECTION
+)
+# fmt: on
 
 # Class that represents the Mouse service.
 class Mouse(HumanInterfaceDevice):
+    HIDS = (                                                                                                            # Service description: describes the service and how we communicate.
+        _UUID_HIDS,                                                                                                     # 0x1812 = Human Interface Device.
+        (
+            (_UUID_HID_INFORMATION, F_READ),                                                                            # 0x2A4A = HID information, to be read by client.
+            (_UUID_HID_REPORT_MAP, F_READ),                                                                             # 0x2A4B = HID report map, to be read by client.
+            (_UUID_HID_CONTROL_POINT, F_READ_WRITE_NORESPONSE),                                                         # 0x2A4C = HID control point, to be written by client.
+            (_UUID_HID_REPORT, F_READ_NOTIFY, (                                                                         # 0x2A4D = HID report, to be read by client after notification.
+                (_UUID_HID_REFERENCE, DSC_F_READ),                                                                      # 0x2908 = HID reference, to be read by client.
+            )),
+            (_UUID_HID_PROTOCOL_MODE, F_READ_WRITE_NORESPONSE),                                                         # 0x2A4E = HID protocol mode, to be written & read by client.
+        ),
+    )
+
     def __init__(self, name="Bluetooth Mouse"):
         super(Mouse, self).__init__(name)                                                                               # Set up the general HID services in super.
         self.device_appearance = 962                                                                                    # Device appearance ID, 962 = mouse.
 
-        self.HIDS = (                                                                                                   # Service description: describes the service and how we communicate.
-            UUID(0x1812),                                                                                               # 0x1812 = Human Interface Device.
-            (
-                (UUID(0x2A4A), F_READ),                                                                                 # 0x2A4A = HID information, to be read by client.
-                (UUID(0x2A4B), F_READ),                                                                                 # 0x2A4B = HID report map, to be read by client.
-                (UUID(0x2A4C), F_READ_WRITE_NORESPONSE),                                                                # 0x2A4C = HID control point, to be written by client.
-                (UUID(0x2A4D), F_READ_NOTIFY, (                                                                         # 0x2A4D = HID report, to be read by client after notification.
-                    (UUID(0x2908), DSC_F_READ),                                                                         # 0x2908 = HID reference, to be read by client.
-                )),
-                (UUID(0x2A4E), F_READ_WRITE_NORESPONSE),                                                                # 0x2A4E = HID protocol mode, to be written & read by client.
-            ),
-        )
-
-        # fmt: off
-        self.HID_INPUT_REPORT = [                                                                                       # Report Description: describes what we communicate.
-            0x05, 0x01,                                                                                                 # USAGE_PAGE (Generic Desktop)
-            0x09, 0x02,                                                                                                 # USAGE (Mouse)
-            0xa1, 0x01,                                                                                                 # COLLECTION (Application)
-            0x85, 0x01,                                                                                                 #   REPORT_ID (1)
-            0x09, 0x01,                                                                                                 #   USAGE (Pointer)
-            0xa1, 0x00,                                                                                                 #   COLLECTION (Physical)
-            0x05, 0x09,                                                                                                 #         Usage Page (Buttons)
-            0x19, 0x01,                                                                                                 #         Usage Minimum (1)
-            0x29, 0x03,                                                                                                 #         Usage Maximum (3)
-            0x15, 0x00,                                                                                                 #         Logical Minimum (0)
-            0x25, 0x01,                                                                                                 #         Logical Maximum (1)
-            0x95, 0x03,                                                                                                 #         Report Count (3)
-            0x75, 0x01,                                                                                                 #         Report Size (1)
-            0x81, 0x02,                                                                                                 #         Input(Data, Variable, Absolute); 3 button bits
-            0x95, 0x01,                                                                                                 #         Report Count(1)
-            0x75, 0x05,                                                                                                 #         Report Size(5)
-            0x81, 0x03,                                                                                                 #         Input(Constant);                 5 bit padding
-            0x05, 0x01,                                                                                                 #         Usage Page (Generic Desktop)
-            0x09, 0x30,                                                                                                 #         Usage (X)
-            0x09, 0x31,                                                                                                 #         Usage (Y)
-            0x09, 0x38,                                                                                                 #         Usage (Wheel)
-            0x15, 0x81,                                                                                                 #         Logical Minimum (-127)
-            0x25, 0x7F,                                                                                                 #         Logical Maximum (127)
-            0x75, 0x08,                                                                                                 #         Report Size (8)
-            0x95, 0x03,                                                                                                 #         Report Count (3)
-            0x81, 0x06,                                                                                                 #         Input(Data, Variable, Relative); 3 position bytes (X,Y,Wheel)
-            0xc0,                                                                                                       #   END_COLLECTION
-            0xc0                                                                                                        # END_COLLECTION
-        ]
-        # fmt: on
+        self.HID_INPUT_REPORT = _REPORT_MAP_MOUSE                                                                       # Report Description: describes what we communicate. Overwrite to use a different report map.
 
         # Define the initial mouse state.
         self.x = 0
         self.y = 0
         self.w = 0
 
-        self.button1 = 0
-        self.button2 = 0
-        self.button3 = 0
+        self._buttons_byte = 0                                                                                          # Bitpacked button states, kept up to date by set_buttons.
+        self._report_buf = bytearray(4)                                                                                 # Preallocated report buffer, reused for every notification.
 
         self.services.append(self.HIDS)                                                                                 # Append to list of service descriptions.
 
@@ -822,13 +1001,15 @@ class Mouse(HumanInterfaceDevice):
     def start(self):
         super(Mouse, self).start()                                                                                      # Call super to register DIS and BAS services.
 
-        print("Registering services")
+        if _DEBUG:
+            print("Registering services")
         handles = self._ble.gatts_register_services(self.services)                                                      # Register services and get read/write handles for all services.
         self.save_service_characteristics(handles)                                                                      # Save the values for the characteristics.
+        self.adv = Advertiser(self._ble, [_UUID_HIDS], self.device_appearance, self.device_name)                        # Create an Advertiser. Only advertise the top level service, i.e., the HIDS.
         self.write_service_characteristics()                                                                            # Write the values for the characteristics.
-        self.adv = Advertiser(self._ble, [UUID(0x1812)], self.device_appearance, self.device_name)                      # Create an Advertiser. Only advertise the top level service, i.e., the HIDS.
 
-        print("Server started")
+        if _DEBUG:
+            print("Server started")
 
     # Overwrite super to save HID specific characteristics.
     def save_service_characteristics(self, handles):
@@ -836,149 +1017,162 @@ class Mouse(HumanInterfaceDevice):
 
         (h_info, h_hid, h_ctrl, self.h_rep, h_d1, h_proto) = handles[3]                                                 # Get the handles for the HIDS characteristics. These correspond directly to self.HIDS. Position 3 because of the order of self.services.
 
-        b = self.button1 + self.button2 * 2 + self.button3 * 4
-        state = struct.pack("Bbbb", b, self.x, self.y, self.w)                                                          # Pack the initial mouse state as described by the input report.
-
-        print("Saving HID service characteristics")
-        self.characteristics[h_info] = ("HID information", b"\x01\x01\x00\x00")                                         # HID info: ver=1.1, country=0, flags=000000cw with c=normally connectable w=wake up signal
-        self.characteristics[h_hid] = ("HID input report map", bytes(self.HID_INPUT_REPORT))                            # HID input report map.
-        self.characteristics[h_ctrl] = ("HID control point", b"\x00")                                                   # HID control point.
-        self.characteristics[self.h_rep] = ("HID report", state)                                                        # HID report.
-        self.characteristics[h_d1] = ("HID reference", struct.pack("<BB", 1, 1))                                        # HID reference: id=1, type=input.
-        self.characteristics[h_proto] = ("HID protocol mode", b"\x01")                                                  # HID protocol mode: report.
+        buf = self._report_buf                                                                                          # Write the initial mouse state as described by the input report.
+        buf[0] = self._buttons_byte
+        buf[1] = self.x & 0xFF
+        buf[2] = self.y & 0xFF
+        buf[3] = self.w & 0xFF
+
+        if _DEBUG:
+            print("Saving HID service characteristics")
+        self.characteristics.update({
+            h_info: ("HID information", HID_INFO_DEFAULT),                                                              # HID info: ver=1.1, country=0, flags=000000cw with c=normally connectable w=wake up signal
+            h_hid: ("HID input report map", self.HID_INPUT_REPORT),                                                     # HID input report map.
+            h_ctrl: ("HID control point", HID_CTRL_ZERO),                                                               # HID control point.
+            self.h_rep: ("HID report", self._report_buf),                                                               # HID report.
+            h_d1: ("HID reference", HID_REF_INPUT_1_1),                                                                 # HID reference: id=1, type=input.
+            h_proto: ("HID protocol mode", HID_PROTO_REPORT),                                                           # HID protocol mode: report.
+        })
 
     # Overwrite super to notify central of a hid report
+    @micropython.native
     def notify_hid_report(self):
-        if self.is_connected():
-            b = self.button1 + self.button2 * 2 + self.button3
-            state = struct.pack("Bbbb", b, self.x, self.y, self.w)                                                      # Pack the mouse state as described by the input report.
-            self.characteristics[self.h_rep] = ("HID report", state)
-            self._ble.gatts_notify(self.conn_handle, self.h_rep, state)                                                 # Notify central by writing to the report handle.
-            print("Notify with report: ", struct.unpack("Bbbb", state))
+        if self.device_state is DEVICE_CONNECTED:
+            buf = self._report_buf                                                                                      # Write the mouse state as described by the input report.
+            buf[0] = self._buttons_byte
+            buf[1] = self.x & 0xFF
+            buf[2] = self.y & 0xFF
+            buf[3] = self.w & 0xFF
+            self._notify(self.conn_handle, self.h_rep, buf)                                                             # Notify central by writing to the report handle.
+            if _DEBUG:
+                print("Notify with report: ", buf)
 
     # Set the mouse axes values.
+    @micropython.native
     def set_axes(self, x=0, y=0):
-        if x > 127:
-            x = 127
-        elif x < -127:
-            x = -127
-
-        if y > 127:
-            y = 127
-        elif y < -127:
-            y = -127
-
-        self.x = x
-        self.y = y
+        self.x = -127 if x < -127 else 127 if x > 127 else x                                                            # Clamp to the logical range of the input report.
+        self.y = -127 if y < -127 else 127 if y > 127 else y
 
     # Set the mouse scroll wheel value.
+    @micropython.native
     def set_wheel(self, w=0):
-        if w > 127:
-            w = 127
-        elif w < -127:
-            w = -127
-
-        self.w = w
+        self.w = -127 if w < -127 else 127 if w > 127 else w                                                            # Clamp to the logical range of the input report.
 
     # Set the mouse button values.
+    @micropython.native
     def set_buttons(self, b1=0, b2=0, b3=0):
-        self.button1 = b1
-        self.button2 = b2
-        self.button3 = b3
+        self._buttons_byte = b1 | (b2 << 1) | (b3 << 2)
+
+    # Set the mouse movement, wheel and buttons (bit 0 = button 1) at once and notify the central.
+    # Movement is relative, so only a report without movement and with unchanged buttons is skipped.
+    @micropython.native
+    def update_state(self, x=0, y=0, w=0, buttons=0):
+        self.x = x = -127 if x < -127 else 127 if x > 127 else x
+        self.y = y = -127 if y < -127 else 127 if y > 127 else y
+        self.w = w = -127 if w < -127 else 127 if w > 127 else w
+        self._buttons_byte = b = buttons & 0x07
+
+        if x or y or w or self._report_buf[0] != b:                                                                     # The report buffer holds the buttons last sent to the central.
+            self.notify_hid_report()
+
+# fmt: off
+_REPORT_MAP_KEYBOARD = (                                                                                                # Keyboard report description.
+    b"\x05\x01"                                                                                                         # USAGE_PAGE (Generic Desktop)
+    b"\x09\x06"                                                                                                         # USAGE (Keyboard)
+    b"\xa1\x01"                                                                                                         # COLLECTION (Application)
+    b"\x85\x01"                                                                                                         #     REPORT_ID (1)
+    b"\x75\x01"                                                                                                         #     Report Size (1)
+    b"\x95\x08"                                                                                                         #     Report Count (8)
+    b"\x05\x07"                                                                                                         #     Usage Page (Key Codes)
+    b"\x19\xE0"                                                                                                         #     Usage Minimum (224)
+    b"\x29\xE7"                                                                                                         #     Usage Maximum (231)
+    b"\x15\x00"                                                                                                         #     Logical Minimum (0)
+    b"\x25\x01"                                                                                                         #     Logical Maximum (1)
+    b"\x81\x02"                                                                                                         #     Input (Data, Variable, Absolute); Modifier byte
+    b"\x95\x01"                                                                                                         #     Report Count (1)
+    b"\x75\x08"                                                                                                         #     Report Size (8)
+    b"\x81\x01"                                                                                                         #     Input (Constant); Reserved byte
+    b"\x95\x05"                                                                                                         #     Report Count (5)
+    b"\x75\x01"                                                                                                         #     Report Size (1)
+    b"\x05\x08"                                                                                                         #     Usage Page (LEDs)
+    b"\x19\x01"                                                                                                         #     Usage Minimum (1)
+    b"\x29\x05"                                                                                                         #     Usage Maximum (5)
+    b"\x91\x02"                                                                                                         #     Output (Data, Variable, Absolute); LED report
+    b"\x95\x01"                                                                                                         #     Report Count (1)
+    b"\x75\x03"                                                                                                         #     Report Size (3)
+    b"\x91\x01"                                                                                                         #     Output (Constant); LED report padding
+    b"\x95\x06"                                                                                                         #     Report Count (6)
+    b"\x75\x08"                                                                                                         #     Report Size (8)
+    b"\x15\x00"                                                                                                         #     Logical Minimum (0)
+    b"\x25\x65"                                                                                                         #     Logical Maximum (101)
+    b"\x05\x07"                                                                                                         #     Usage Page (Key Codes)
+    b"\x19\x00"                                                                                                         #     Usage Minimum (0)
+    b"\x29\x65"                                                                                                         #     Usage Maximum (101)
+    b"\x81\x00"                                                                                                         #     Input (Data, Array); Key array (6 bytes)
+    b"\xc0"                                                                                                             # END_COLLECTION
+)
+# fmt: on
 
 # Class that represents the Keyboard service.
 class Keyboard(HumanInterfaceDevice):
+    HIDS = (                                                                                                            # Service description: describes the service and how we communicate.
+        _UUID_HIDS,                                                                                                     # Human Interface Device.
+        (
+            (_UUID_HID_INFORMATION, F_READ),                                                                            # 0x2A4A = HID information, to be read by client.
+            (_UUID_HID_REPORT_MAP, F_READ),                                                                             # 0x2A4B = HID report map, to be read by client.
+            (_UUID_HID_CONTROL_POINT, F_READ_WRITE_NORESPONSE),                                                         # 0x2A4C = HID control point, to be written by client.
+            (_UUID_HID_REPORT, F_READ_NOTIFY, (                                                                         # 0x2A4D = HID report, to be read by client after notification.
+                (_UUID_HID_REFERENCE, DSC_F_READ),                                                                      # 0x2908 = HID reference, to be read by client.
+            )),
+            (_UUID_HID_REPORT, F_READ_WRITE, (                                                                          # 0x2A4D = HID report
+                (_UUID_HID_REFERENCE, DSC_F_READ),                                                                      # 0x2908 = HID reference, to be read by client.
+            )),
+            (_UUID_HID_PROTOCOL_MODE, F_READ_WRITE_NORESPONSE),                                                         # 0x2A4E = HID protocol mode, to be written & read by client.
+        ),
+    )
+
     def __init__(self, name="Bluetooth Keyboard"):
         super(Keyboard, self).__init__(name)                                                                            # Set up the general HID services in super.
         self.device_appearance = 961                                                                                    # Device appearance ID, 961 = keyboard.
 
-        self.HIDS = (                                                                                                   # Service description: describes the service and how we communicate.
-            UUID(0x1812),                                                                                               # Human Interface Device.
-            (
-                (UUID(0x2A4A), F_READ),                                                                                 # 0x2A4A = HID information, to be read by client.
-                (UUID(0x2A4B), F_READ),                                                                                 # 0x2A4B = HID report map, to be read by client.
-                (UUID(0x2A4C), F_READ_WRITE_NORESPONSE),                                                                # 0x2A4C = HID control point, to be written by client.
-                (UUID(0x2A4D), F_READ_NOTIFY, (                                                                         # 0x2A4D = HID report, to be read by client after notification.
-                    (UUID(0x2908), DSC_F_READ),                                                                         # 0x2908 = HID reference, to be read by client.
-                )),
-                (UUID(0x2A4D), F_READ_WRITE, (                                                                          # 0x2A4D = HID report
-                    (UUID(0x2908), DSC_F_READ),                                                                         # 0x2908 = HID reference, to be read by client.
-                )),
-                (UUID(0x2A4E), F_READ_WRITE_NORESPONSE),                                                                # 0x2A4E = HID protocol mode, to be written & read by client.
-            ),
-        )
-
-        # fmt: off
-        self.HID_INPUT_REPORT = [                                                                                       # Report Description: describes what we communicate.
-            0x05, 0x01,                                                                                                 # USAGE_PAGE (Generic Desktop)
-            0x09, 0x06,                                                                                                 # USAGE (Keyboard)
-            0xa1, 0x01,                                                                                                 # COLLECTION (Application)
-            0x85, 0x01,                                                                                                 #     REPORT_ID (1)
-            0x75, 0x01,                                                                                                 #     Report Size (1)
-            0x95, 0x08,                                                                                                 #     Report Count (8)
-            0x05, 0x07,                                                                                                 #     Usage Page (Key Codes)
-            0x19, 0xE0,                                                                                                 #     Usage Minimum (224)
-            0x29, 0xE7,                                                                                                 #     Usage Maximum (231)
-            0x15, 0x00,                                                                                                 #     Logical Minimum (0)
-            0x25, 0x01,                                                                                                 #     Logical Maximum (1)
-            0x81, 0x02,                                                                                                 #     Input (Data, Variable, Absolute); Modifier byte
-            0x95, 0x01,                                                                                                 #     Report Count (1)
-            0x75, 0x08,                                                                                                 #     Report Size (8)
-            0x81, 0x01,                                                                                                 #     Input (Constant); Reserved byte
-            0x95, 0x05,                                                                                                 #     Report Count (5)
-            0x75, 0x01,                                                                                                 #     Report Size (1)
-            0x05, 0x08,                                                                                                 #     Usage Page (LEDs)
-            0x19, 0x01,                                                                                                 #     Usage Minimum (1)
-            0x29, 0x05,                                                                                                 #     Usage Maximum (5)
-            0x91, 0x02,                                                                                                 #     Output (Data, Variable, Absolute); LED report
-            0x95, 0x01,                                                                                                 #     Report Count (1)
-            0x75, 0x03,                                                                                                 #     Report Size (3)
-            0x91, 0x01,                                                                                                 #     Output (Constant); LED report padding
-            0x95, 0x06,                                                                                                 #     Report Count (6)
-            0x75, 0x08,                                                                                                 #     Report Size (8)
-            0x15, 0x00,                                                                                                 #     Logical Minimum (0)
-            0x25, 0x65,                                                                                                 #     Logical Maximum (101)
-            0x05, 0x07,                                                                                                 #     Usage Page (Key Codes)
-            0x19, 0x00,                                                                                                 #     Usage Minimum (0)
-            0x29, 0x65,                                                                                                 #     Usage Maximum (101)
-            0x81, 0x00,                                                                                                 #     Input (Data, Array); Key array (6 bytes)
-            0xc0                                                                                                        # END_COLLECTION
-        ]
-        # fmt: on
+        self.HID_INPUT_REPORT = _REPORT_MAP_KEYBOARD                                                                    # Report Description: describes what we communicate. Overwrite to use a different report map.
 
         # Define the initial keyboard state.
         self.modifiers = 0                                                                                              # 8 bits signifying Right GUI(Win/Command), Right ALT/Option, Right Shift, Right Control, Left GUI, Left ALT, Left Shift, Left Control.
-        self.keypresses = [0x00] * 6                                                                                    # 6 keys to hold.
+        self.keypresses = bytearray(6)                                                                                  # 6 keys to hold.
+        self._report_buf = bytearray(8)                                                                                 # The input report, packed in place on every notify.
+        self._dirty = False                                                                                             # Whether the modifiers or keys changed since the last notify.
 
         self.kb_callback = None                                                                                         # Callback function for keyboard messages from client.
 
         self.services.append(self.HIDS)                                                                                 # Append to list of service descriptions.
 
-    # Interrupt request callback function
+    # Write operation from client.
     # Overwrite super to catch keyboard report write events by the central.
-    def ble_irq(self, event, data):
-        if event == _IRQ_GATTS_WRITE:                                                                                   # If a client has written to a characteristic or descriptor.
-            conn_handle, attr_handle = data                                                                             # Get the handle to the characteristic that was written.
-            if attr_handle == self.h_repout:
+    def _on_gatts_write(self, data):
+        conn_handle, attr_handle = data                                                                                 # Get the handle to the characteristic that was written.
+        if attr_handle == self.h_repout:
+            if _DEBUG:
                 print("Keyboard changed by Central")
-                report = self._ble.gatts_read(attr_handle)                                                              # Read the report.
-                bytes = struct.unpack("B", report)                                                                      # Unpack the report.
-                if self.kb_callback is not None:                                                                        # Call the callback function.
-                    self.kb_callback(bytes)
-                return _GATTS_NO_ERROR
+            report = self._read(attr_handle)                                                                            # Read the report.
+            if self.kb_callback is not None:                                                                            # Call the callback function with a view of the raw report.
+                self.kb_callback(memoryview(report))
+            return _GATTS_NO_ERROR
 
-        return super(Keyboard, self).ble_irq(event, data)                                                               # Let super handle the event.
+        return _base_on_gatts_write(self, data)                                                                         # Let super handle the write.
 
     # Overwrite super to register HID specific service.
     def start(self):
         super(Keyboard, self).start()                                                                                   # Call super to register DIS and BAS services.
 
-        print("Registering services")
+        if _DEBUG:
+            print("Registering services")
         handles = self._ble.gatts_register_services(self.services)                                                      # Register services and get read/write handles for all services.
         self.save_service_characteristics(handles)                                                                      # Save the values for the characteristics.
+        self.adv = Advertiser(self._ble, [_UUID_HIDS], self.device_appearance, self.device_name)                        # Create an Advertiser. Only advertise the top level service, i.e., the HIDS.
         self.write_service_characteristics()                                                                            # Write the values for the characteristics.
-        self.adv = Advertiser(self._ble, [UUID(0x1812)], self.device_appearance, self.device_name)                      # Create an Advertiser. Only advertise the top level service, i.e., the HIDS.
-        print("Server started")
+        if _DEBUG:
+            print("Server started")
 
     # Overwrite super to save HID specific characteristics.
     def save_service_characteristics(self, handles):
@@ -986,37 +1180,64 @@ class Keyboard(HumanInterfaceDevice):
 
         (h_info, h_hid, h_ctrl, self.h_rep, h_d1, self.h_repout, h_d2, h_proto) = handles[3]                            # Get the handles for the HIDS characteristics. These correspond directly to self.HIDS. Position 3 because of the order of self.services.
 
-        state = struct.pack("8B", self.modifiers, 0, self.keypresses[0], self.keypresses[1], self.keypresses[2], self.keypresses[3], self.keypresses[4], self.keypresses[5])
-
-        print("Saving HID service characteristics")
-        self.characteristics[h_info] = ("HID information", b"\x01\x01\x00\x00")                                         # HID info: ver=1.1, country=0, flags=000000cw with c=normally connectable w=wake up signal
-        self.characteristics[h_hid] = ("HID input report map", bytes(self.HID_INPUT_REPORT))                            # HID input report map.
-        self.characteristics[h_ctrl] = ("HID control point", b"\x00")                                                   # HID control point.
-        self.characteristics[self.h_rep] = ("HID input report", state)                                                  # HID report.
-        self.characteristics[h_d1] = ("HID input reference", struct.pack("<BB", 1, 1))                                  # HID reference: id=1, type=input.
-        self.characteristics[self.h_repout] = ("HID output report", state)                                              # HID report.
-        self.characteristics[h_d2] = ("HID output reference", struct.pack("<BB", 1, 2))                                 # HID reference: id=1, type=output.
-        self.characteristics[h_proto] = ("HID protocol mode", b"\x01")                                                  # HID protocol mode: report.
+        self._report_buf[0] = self.modifiers                                                                            # Set the initial keyboard state as described by the input report.
+        self._report_buf[2:8] = self.keypresses
+
+        if _DEBUG:
+            print("Saving HID service characteristics")
+        self.characteristics.update({
+            h_info: ("HID information", HID_INFO_DEFAULT),                                                              # HID info: ver=1.1, country=0, flags=000000cw with c=normally connectable w=wake up signal
+            h_hid: ("HID input report map", self.HID_INPUT_REPORT),                                                     # HID input report map.
+            h_ctrl: ("HID control point", HID_CTRL_ZERO),                                                               # HID control point.
+            self.h_rep: ("HID input report", self._report_buf),                                                         # HID report.
+            h_d1: ("HID input reference", HID_REF_INPUT_1_1),                                                           # HID reference: id=1, type=input.
+            self.h_repout: ("HID output report", bytes(self._report_buf)),                                              # HID report.
+            h_d2: ("HID output reference", HID_REF_OUTPUT_1_2),                                                         # HID reference: id=1, type=output.
+            h_proto: ("HID protocol mode", HID_PROTO_REPORT),                                                           # HID protocol mode: report.
+        })
 
     # Overwrite super to notify central of a hid report.
+    # Only sends a report if the modifiers or keys were set since the last report.
+    @micropython.native
     def notify_hid_report(self):
-        if self.is_connected():
-            # Pack the Keyboard state as described by the input report.
-            state = struct.pack("8B", self.modifiers, 0, self.keypresses[0], self.keypresses[1], self.keypresses[2], self.keypresses[3], self.keypresses[4], self.keypresses[5])
-            self.characteristics[self.h_rep] = ("HID input report", state)
-            self._ble.gatts_notify(self.conn_handle, self.h_rep, state)                                                 # Notify central by writing to the report handle.
-            print("Notify with report: ", struct.unpack("8B", state))
+        if self.device_state is DEVICE_CONNECTED and self._dirty:
+            # Copy the Keyboard state into the report as described by the input report. Byte 1 is reserved and stays 0.
+            buf = self._report_buf
+            buf[0] = self.modifiers
+            buf[2:8] = self.keypresses
+            self._notify(self.conn_handle, self.h_rep, self._report_buf)                                                # Notify central by writing to the report handle.
+            self._dirty = False
+            if _DEBUG:
+                print("Notify with report: ", self._report_buf)
 
     # Set the modifier bits, notify to send the modifiers to central.
     def set_modifiers(self, right_gui=0, right_alt=0, right_shift=0, right_control=0, left_gui=0, left_alt=0, left_shift=0, left_control=0):
-        self.modifiers = (right_gui << 7) + (right_alt << 6) + (right_shift << 5) + (right_control << 4) + (left_gui << 3) + (left_alt << 2) + (left_shift << 1) + left_control
+        self.modifiers = (right_gui << 7) | (right_alt << 6) | (right_shift << 5) | (right_control << 4) | (left_gui << 3) | (left_alt << 2) | (left_shift << 1) | left_control
+        self._dirty = True
 
     # Press keys, notify to send the keys to central.
     # This will hold down the keys, call set_keys() without arguments and notify again to release.
     def set_keys(self, k0=0x00, k1=0x00, k2=0x00, k3=0x00, k4=0x00, k5=0x00):
-        self.keypresses = [k0, k1, k2, k3, k4, k5]
+        keys = self.keypresses
+        keys[0] = k0
+        keys[1] = k1
+        keys[2] = k2
+        keys[3] = k3
+        keys[4] = k4
+        keys[5] = k5
+        self._dirty = True
+
+    # Set the modifiers and/or keys and send them to the central in a single report.
+    # mods is a dict of set_modifiers() arguments, keys a sequence of up to 6 key codes.
+    # Call press(mods={}, keys=()) to release all modifiers and keys.
+    def press(self, mods=None, keys=None):
+        if mods is not None:
+            self.set_modifiers(**mods)
+        if keys is not None:
+            self.set_keys(*keys)
+        self.notify_hid_report()
 
     # Set a callback function that gets notified on keyboard changes.
-    # Should take a tuple with the report bytes.
+    # Should take a memoryview of the raw output report written by the central, e.g., the LED state.
     def set_kb_callback(self, kb_callback):
         self.kb_callback = kb_callback